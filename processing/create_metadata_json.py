@@ -19,12 +19,15 @@ structure:
 }
 """
 
-from copy import deepcopy
-import json
+from collections import Counter
+from dataclasses import dataclass, fields
+import logging
+import multiprocessing
 import os
 from pathlib import Path
+from typing import Optional
 
-import numpy as np
+import orjson
 from tqdm import tqdm
 
 import weblinx as wl
@@ -32,43 +35,35 @@ import weblinx.processing as wlp
 import weblinx.eval
 
 
-def convert_html_path_to_playwright(html_path: Path, replace_with="axtrees") -> Path:
-    # replace the directory "/pages/" with "/axtrees/" and the extension ".html" with ".json"
-    # find the name of part that contains "pages" and replace it with "axtrees"
-    parts = html_path.parts
-    idx = parts.index("pages")
-    parts = parts[:idx] + (replace_with,) + parts[idx + 1 :]
-    # replace the extension ".html" with ".json"
-    return Path(*parts).with_suffix(".json")
+pages_sep = f"{os.sep}pages{os.sep}"
 
 
-wl_data_dir = "wl_data"
-uid_key = "data-webtasks-id"
-
+def split_html_path(html_path: str) -> tuple:
+    # split the path around the "/pages/" directory, and replace the extension ".html" with ".json", so
+    # that the snapshot paths of a page can be built by only swapping the middle directory. We work on
+    # the string form since a single str.split is much cheaper than rebuilding Path parts
+    head, tail = html_path.split(pages_sep, 1)
+    return head, os.path.splitext(tail)[0] + ".json"
 
-results = {}
 
-splits = [
-    'train',
-    'valid',
-    'test_iid',
-    'test_geo',
-    'test_vis',
-    'test_web',
-    'test_cat',
-]
+def path_exists(path, base_dir: Path, dir_listings: dict) -> bool:
+    # list each directory once with os.scandir, so that checking a file is a set lookup instead of a
+    # stat call. A missing directory is listed as empty, so its files are all reported as missing
+    parent, name = os.path.split(path)
+    if parent not in dir_listings:
+        try:
+            with os.scandir(os.path.join(base_dir, parent)) as entries:
+                dir_listings[parent] = {entry.name for entry in entries}
+        except OSError:
+            dir_listings[parent] = set()
+    return name in dir_listings[parent]
 
-for split in splits:
-    demos = wl.load_demos_in_split(
-        split=split,
-        split_path=Path(wl_data_dir) / "splits.json",
-        demo_base_dir=Path(wl_data_dir) / "demonstrations",
-    )
 
+wl_data_dir = "wl_data"
+uid_key = "data-webtasks-id"
 
-    results[split] = {}
-
-    valid_intents = {
+valid_intents = frozenset(
+    {
         "click",
         "hover",
         "textInput",
@@ -79,225 +74,341 @@ for split in splits:
         "tabremove",
         "submit",
     }
+)
+
+intents_with_element = frozenset({"click", "hover", "textinput", "submit"})
+intents_without_args = frozenset({"tabcreate"})
+bbox_keys = ("top", "right", "bottom", "left", "x", "y", "width", "height")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True, kw_only=True)
+class Step:
+    """
+    A step of a demo, as saved in metadata.json. We use a slotted dataclass rather than a dict
+    since a demo holds a record for every one of its turns until it is written.
+    """
+
+    intent: str
+    args: dict
+    is_task: bool
+    has_full_snapshot: bool
+    timestamp: float
+    screenshot_path: str
+    bbox_path: str
+    html_path: str
+    tab: dict
+    zoom: float
+
+    # snapshot info from playwright starts here:
+    axtree_path: Optional[str]
+    dom_object_path: Optional[str]
+    extra_props_path: Optional[str]
+    focused_element_uid: Optional[str] = None
+
+    # demo-level metadata
+    user_sees_screen: bool
+    uses_ai_output: bool
+    annotator_id: str
+    upload_date: str
+
+    element: Optional[dict] = None
+    num_actions: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        d = {name: getattr(self, name) for name in step_field_names}
+        # the element is only saved for the steps that have one
+        if self.element is None:
+            del d["element"]
+        return d
+
+
+step_field_names = tuple(field.name for field in fields(Step))
+
+# step numbers are int keys, so we need OPT_NON_STR_KEYS. Steps are converted to dicts by orjson
+# through Step.to_dict, only when they are written
+json_options = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS
+
+
+def dumps_nested(obj, level: int) -> bytes:
+    # orjson indents relative to the object being dumped, so we shift every line to sit at the given level.
+    # newlines inside strings are escaped, so the only raw newlines are the ones added for indentation
+    dumped = orjson.dumps(obj, default=Step.to_dict, option=json_options)
+    return dumped.replace(b"\n", b"\n" + b"  " * level)
+
+
+def process_demo(demo) -> tuple[str, dict]:
+    """
+    Build the metadata of every step in a demo. Returns the demo name and a dict mapping the
+    turn index to the step metadata. This runs in a worker process, so it must not rely on any
+    state shared with other demos.
+    """
+    demo_start_time = demo.metadata["recordingStart"]
+    replay = wl.Replay.from_demonstration(demo)
+
+    demo_results = {}
+    num_actions = 0
+
+    demo_name_path = Path(demo.name)
+    last_screenshot = demo_name_path / "screenshots" / "screenshot-0-0.png"
+    last_bbox = demo_name_path / "bboxes" / "bboxes-0.json"
+    last_html = demo_name_path / "pages" / "page-0-0.html"
+
+    last_url = None
+    last_tab_id = None
+
+    base_dir = Path(demo.base_dir)
+    dir_listings = {}
+    # we only log the individual issues at debug level, and log a single summary per demo
+    issue_counts = Counter()
+
+    if not path_exists(last_screenshot, base_dir, dir_listings):
+        logger.debug("File not found: %s", last_screenshot)
+        issue_counts["file not found"] += 1
+        last_screenshot = None
+
+    if not path_exists(last_bbox, base_dir, dir_listings):
+        logger.debug("File not found: %s", last_bbox)
+        issue_counts["file not found"] += 1
+        last_bbox = None
+
+    if not path_exists(last_html, base_dir, dir_listings):
+        logger.debug("File not found: %s", last_html)
+        issue_counts["file not found"] += 1
+        last_html = None
+
+    tab_id_to_url = {}
+
+    # the demo-level metadata is the same for every step, so we only look it up once
+    demo_metadata = {
+        'user_sees_screen': demo.form['instructor_sees_screen'],
+        'uses_ai_output': demo.form['uses_ai_generated_output'],
+        'annotator_id': demo.form['annotator'],
+        'upload_date': demo.form['upload_date'],
+    }
 
-    intents_with_element = {"click", "hover", "textinput", "submit"}
-    intents_without_args = {"tabcreate"}
-
-    for demo in tqdm(demos, desc=f"Processing {split} demos"):
-        demo_id = demo.name
-        demo_start_time = demo.metadata["recordingStart"]
-        replay = wl.Replay.from_demonstration(demo)
-
-        results[split][demo_id] = {}
-        action_history = []
-
-        demo_name_path = Path(demo.name)
-        last_screenshot = demo_name_path / "screenshots" / "screenshot-0-0.png"
-        last_bbox = demo_name_path / "bboxes" / "bboxes-0.json"
-        last_html = demo_name_path / "pages" / "page-0-0.html"
-
-        last_url = None
-        last_tab_id = None
-
-        if not Path(demo.base_dir).joinpath(last_screenshot).exists():
-            print(f"File not found: {last_screenshot}")
-            last_screenshot = None
-
-        if not Path(demo.base_dir).joinpath(last_bbox).exists():
-            print(f"File not found: {last_bbox}")
-            last_bbox = None
-
-        if not Path(demo.base_dir).joinpath(last_html).exists():
-            print(f"File not found: {last_html}")
-            last_html = None
-
-        tab_id_to_url = {}
-
-        for i, turn in enumerate(replay):
-            if turn.type == "browser" and turn.intent not in valid_intents:
-                continue
-            
-            # if there's no screenshot and there's no last screenshot, skip, otherwise use last screenshot
-            if not turn.has_screenshot():
-                if last_screenshot is None:
-                    continue
-                else:
-                    screenshot_path = last_screenshot
-            else:
-                # otherwise, use the current screenshot
-                screenshot_path = Path(turn.get_screenshot_path())
-                screenshot_path = screenshot_path.relative_to(turn.base_dir)
-
-                last_screenshot = screenshot_path
-
-            # if one of html or bbox is missing, skip since we want to avoid mismatch
-            only_missing_html = not turn.has_html() and turn.has_bboxes()
-            only_missing_bbox = turn.has_html() and not turn.has_bboxes()
-            if only_missing_html or only_missing_bbox:
+    # filter out browser turns with unsupported intents before doing any per-turn work
+    valid_turns = [
+        (i, turn)
+        for i, turn in enumerate(replay)
+        if not (turn.type == "browser" and turn.intent not in valid_intents)
+    ]
+
+    for i, turn in valid_turns:
+        # if there's no screenshot and there's no last screenshot, skip, otherwise use last screenshot
+        if not turn.has_screenshot():
+            if last_screenshot is None:
                 continue
-
-            # if missing both, take last ones unless they're missing
-            missing_both = not turn.has_html() and not turn.has_bboxes()
-
-            if missing_both:
-                if last_html is None or last_bbox is None:
-                    continue
-                else:
-                    html_path = last_html
-                    bbox_path = last_bbox
             else:
-                html_path = Path(turn.get_html_path())
-                bbox_path = Path(turn.get_bboxes_path())
-
-                html_path = html_path.relative_to(turn.base_dir)
-                bbox_path = bbox_path.relative_to(turn.base_dir)
+                screenshot_path = last_screenshot
+        else:
+            # otherwise, use the current screenshot
+            screenshot_path = Path(turn.get_screenshot_path())
+            screenshot_path = screenshot_path.relative_to(turn.base_dir)
 
-                last_html = html_path
-                last_bbox = bbox_path
+            last_screenshot = screenshot_path
 
-            base_dir = Path(turn.base_dir)
-            # check if replacing html_path to get dom_object_path works, if not we mark it as none
-            dom_obj_path = convert_html_path_to_playwright(
-                html_path, replace_with="dom_snapshots"
-            )
-            axtree_path = convert_html_path_to_playwright(html_path, replace_with="axtrees")
-            extra_props_path = convert_html_path_to_playwright(
-                html_path, replace_with="extra_element_properties"
-            )
+        # has_html and has_bboxes check the filesystem, so we only call them once
+        has_html = turn.has_html()
+        has_bboxes = turn.has_bboxes()
 
-            if not base_dir.joinpath(dom_obj_path).exists():
-                dom_obj_path = None
-            else:
-                dom_obj_path = str(dom_obj_path)
+        # if one of html or bbox is missing, skip since we want to avoid mismatch
+        if has_html != has_bboxes:
+            continue
 
-            if not base_dir.joinpath(axtree_path).exists():
-                axtree_path = None
-            else:
-                axtree_path = str(axtree_path)
+        # if missing both, take last ones unless they're missing
+        missing_both = not has_html and not has_bboxes
 
-            if not base_dir.joinpath(extra_props_path).exists():
-                extra_props_path = None
-            else:
-                extra_props_path = str(extra_props_path)
-
-            ref_action = wlp.outputs.extract_action_from_turn(turn)
-            intent = ref_action["intent"]
-            args = ref_action["args"]
-            element = ref_action["element"]
-
-            # find the tab_id by looking at the last tab_id if it's not provided
-            if turn.tab_id is None:
-                tab_id = last_tab_id
-            elif turn.intent in ["tabcreate", "tabswitch"]:
-                tab_id = turn.args["properties"]["tabId"]  # created/switched target tab id
-                last_tab_id = tab_id
+        if missing_both:
+            if last_html is None or last_bbox is None:
+                continue
             else:
-                tab_id = turn.tab_id
-                last_tab_id = tab_id
-
-            # find the correct url by looking at the last url if it's not provided
-            if turn.url is None or turn.url == "":
-                if intent == "tabcreate":
-                    url = "about:blank"
-                else:
-                    url = tab_id_to_url.get(tab_id, last_url)
+                html_path = last_html
+                bbox_path = last_bbox
+        else:
+            html_path = Path(turn.get_html_path())
+            bbox_path = Path(turn.get_bboxes_path())
+
+            html_path = html_path.relative_to(turn.base_dir)
+            bbox_path = bbox_path.relative_to(turn.base_dir)
+
+            last_html = html_path
+            last_bbox = bbox_path
+
+        # check if replacing html_path to get dom_object_path works, if not we mark it as none
+        head, tail = split_html_path(str(html_path))
+        dom_obj_path = os.path.join(head, "dom_snapshots", tail)
+        axtree_path = os.path.join(head, "axtrees", tail)
+        extra_props_path = os.path.join(head, "extra_element_properties", tail)
+
+        if not path_exists(dom_obj_path, base_dir, dir_listings):
+            dom_obj_path = None
+
+        if not path_exists(axtree_path, base_dir, dir_listings):
+            axtree_path = None
+
+        if not path_exists(extra_props_path, base_dir, dir_listings):
+            extra_props_path = None
+
+        ref_action = wlp.outputs.extract_action_from_turn(turn)
+        intent = ref_action["intent"]
+        args = ref_action["args"]
+        element = ref_action["element"]
+
+        # find the tab_id by looking at the last tab_id if it's not provided
+        if turn.tab_id is None:
+            tab_id = last_tab_id
+        elif turn.intent in ["tabcreate", "tabswitch"]:
+            tab_id = turn.args["properties"]["tabId"]  # created/switched target tab id
+            last_tab_id = tab_id
+        else:
+            tab_id = turn.tab_id
+            last_tab_id = tab_id
+
+        # find the correct url by looking at the last url if it's not provided
+        if turn.url is None or turn.url == "":
+            if intent == "tabcreate":
+                url = "about:blank"
             else:
-                url = turn.url
-                last_url = url
-                tab_id_to_url[tab_id] = url
-
-            if intent in intents_with_element and element is None:
-                # skip if the element is None
+                url = tab_id_to_url.get(tab_id, last_url)
+        else:
+            url = turn.url
+            last_url = url
+            tab_id_to_url[tab_id] = url
+
+        if intent in intents_with_element and element is None:
+            # skip if the element is None
+            continue
+
+        if element is not None:
+            # first, move the uid to the args, if it exists (if not, we skip)
+            if uid_key not in element["attributes"]:
                 continue
-
-            if element is not None:
-                # first, move the uid to the args, if it exists (if not, we skip)
-                if uid_key not in element["attributes"]:
-                    continue
-                else:
-                    args["uid"] = element["attributes"][uid_key]
-
-                # second, check if the element has more than one attribute, if not we delete it
-                if len(element) > 1 and len(element["attributes"]) > 1:
-                    print("Element with more than one attribute:", element)
-                else:
-                    del element["attributes"]
-
-                # for top, right, bottom, left, we round them to nearest decimal point
-                for k in ["top", "right", "bottom", "left", "x", "y", "width", "height"]:
-                    element["bbox"][k] = round(element["bbox"][k], 1)
-
-            if len(args) == 0 and intent not in intents_without_args:
-                print("Empty args:", ref_action)
-
-            # for tabremove, we change "tab_id" to "target"
-            if intent == "tabremove":
-                args["target"] = args["tab_id"]
-                del args["tab_id"]
-
-            # for tabswitch, we change tab_id_from to origin and tab_id_to to target
-            if intent == "tabswitch":
-                args["origin"] = args["tab_id_from"]
-                args["target"] = args["tab_id_to"]
-                del args["tab_id_from"]
-                del args["tab_id_to"]
-
-            if intent == "textinput":
-                args["value"] = args.pop("text")
-
-            # mark a step as is_task if it's not a instructor utterance
-            if intent == "say" and args["speaker"] == "instructor":
-                is_task = False
             else:
-                is_task = True
+                args["uid"] = element["attributes"][uid_key]
 
-            has_full_snapshot = (
-                axtree_path is not None
-                and dom_obj_path is not None
-                and extra_props_path is not None
+            # second, check if the element has more than one attribute, if not we delete it
+            if len(element) > 1 and len(element["attributes"]) > 1:
+                logger.debug("Element with more than one attribute: %s", element)
+                issue_counts["element with more than one attribute"] += 1
+            else:
+                del element["attributes"]
+
+            # for top, right, bottom, left, we round them to nearest decimal point
+            bbox = element["bbox"]
+            bbox.update({k: round(bbox[k], 1) for k in bbox_keys})
+
+        if len(args) == 0 and intent not in intents_without_args:
+            logger.debug("Empty args: %s", ref_action)
+            issue_counts["empty args"] += 1
+
+        # for tabremove, we change "tab_id" to "target"
+        if intent == "tabremove":
+            args["target"] = args["tab_id"]
+            del args["tab_id"]
+
+        # for tabswitch, we change tab_id_from to origin and tab_id_to to target
+        if intent == "tabswitch":
+            args["origin"] = args["tab_id_from"]
+            args["target"] = args["tab_id_to"]
+            del args["tab_id_from"]
+            del args["tab_id_to"]
+
+        if intent == "textinput":
+            args["value"] = args.pop("text")
+
+        # mark a step as is_task if it's not a instructor utterance
+        if intent == "say" and args["speaker"] == "instructor":
+            is_task = False
+        else:
+            is_task = True
+
+        has_full_snapshot = (
+            axtree_path is not None
+            and dom_obj_path is not None
+            and extra_props_path is not None
+        )
+
+        # count the actions, we only need the number of actions rather than the full history
+        num_actions += 1
+
+        # get zoom level
+        zoom = turn.zoom if turn.zoom is not None else 1.0
+
+        demo_results[i] = Step(
+            intent=intent,
+            args=args,
+            is_task=is_task,
+            has_full_snapshot=has_full_snapshot,
+            timestamp=demo_start_time + turn.timestamp,
+            screenshot_path=str(screenshot_path),
+            bbox_path=str(bbox_path),
+            html_path=str(html_path),
+            tab={"url": url, "id": tab_id},
+            zoom=zoom,
+            axtree_path=axtree_path,
+            dom_object_path=dom_obj_path,
+            extra_props_path=extra_props_path,
+            element=element,
+            **demo_metadata,
+        )
+
+    # update each with number of actions; the metadata readers expect it on every step, so we
+    # keep it there rather than storing it once per demo
+    for step in demo_results.values():
+        step.num_actions = num_actions
+
+    if issue_counts:
+        logger.warning("Demo %s: %s", demo.name, dict(issue_counts))
+
+    return demo.name, demo_results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(message)s")
+
+    splits = [
+        'train',
+        'valid',
+        'test_iid',
+        'test_geo',
+        'test_vis',
+        'test_web',
+        'test_cat',
+    ]
+
+    # we write each demo as soon as it's processed, rather than building the whole metadata dict in memory.
+    # the demos are written to a temporary file, which only replaces metadata.json once it is complete, so
+    # that a failed or interrupted run doesn't leave a truncated metadata.json behind
+    metadata_path = "metadata.json"
+    tmp_metadata_path = metadata_path + ".tmp"
+
+    with multiprocessing.Pool(os.cpu_count()) as pool, open(tmp_metadata_path, "wb") as f:
+        f.write(b"{")
+
+        for split_num, split in enumerate(splits):
+            demos = wl.load_demos_in_split(
+                split=split,
+                split_path=Path(wl_data_dir) / "splits.json",
+                demo_base_dir=Path(wl_data_dir) / "demonstrations",
             )
 
-            # update action history
-            action_history.append(ref_action)
-
-            # get zoom level
-            zoom = turn.zoom if turn.zoom is not None else 1.0
-
-            d = {
-                "intent": intent,
-                "args": args,
-                "is_task": is_task,
-                "has_full_snapshot": has_full_snapshot,
-                "timestamp": demo_start_time + turn.timestamp,
-                "screenshot_path": str(screenshot_path),
-                "bbox_path": str(bbox_path),
-                "html_path": str(html_path),
-                "tab": {"url": url, "id": tab_id},
-                "zoom": zoom,
-                
-                # snapshot info from playwright starts here:
-                "axtree_path": axtree_path,
-                "dom_object_path": dom_obj_path,
-                "extra_props_path": extra_props_path,
-                "focused_element_uid": None,
-                
-                # demo-level metadata
-                'user_sees_screen': demo.form['instructor_sees_screen'],
-                'uses_ai_output': demo.form['uses_ai_generated_output'],
-                'annotator_id': demo.form['annotator'],
-                'upload_date': demo.form['upload_date'],
-            }
+            if split_num > 0:
+                f.write(b",")
+            f.write(b"\n  " + orjson.dumps(split) + b": {")
 
-            if element is not None:
-                d["element"] = element
+            # imap (rather than imap_unordered) keeps the demos in the same order as the split
+            demo_iter = pool.imap(process_demo, demos, chunksize=8)
+            for demo_num, (demo_id, demo_results) in enumerate(
+                tqdm(demo_iter, total=len(demos), desc=f"Processing {split} demos")
+            ):
+                if demo_num > 0:
+                    f.write(b",")
+                f.write(b"\n    " + orjson.dumps(demo_id) + b": " + dumps_nested(demo_results, level=2))
 
-            results[split][demo_id][i] = d
+            f.write(b"\n  }" if len(demos) > 0 else b"}")
 
-        # update each with number of actions
-        num_actions = len(action_history)
-        for i in results[split][demo_id]:
-            results[split][demo_id][i]["num_actions"] = num_actions
+        f.write(b"\n}")
 
-# now, we can save the results
-with open("metadata.json", "w") as f:
-    json.dump(results, f, indent=2)
+    os.replace(tmp_metadata_path, metadata_path)
@@ -4,6 +4,7 @@ Given WebLINX-full, this will zip everything in demonstrations and move them to
 import os
 import json
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 
 from tqdm import tqdm
 
@@ -12,49 +13,80 @@ base_dir = os.path.expanduser('~/scratch/WebLINX-full')
 source_dir = os.path.join(base_dir, 'demonstrations')
 output_dir = os.path.join(base_dir, 'demonstrations_zip')
 
-# Create the output directory if it doesn't exist
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
+# create a done.jsonl file to indicate that the zipping is complete for a given directory, so we don't zip it again.
+# each line is a [folder_name, zip_filename] pair, so that marking a folder as done is a single append
+done_file = os.path.join('./weblinx_zipping_done.jsonl')
+# older runs saved the whole done dict to a json file, we convert it to the jsonl format on first run
+legacy_done_file = os.path.join('./weblinx_zipping_done.json')
 
-# create a done.json file to indicate that the zipping is complete for a given directory, so we don't zip it again
-done_file = os.path.join('./weblinx_zipping_done.json')
-if not os.path.exists(done_file):
-    done = {}
+# the zips are written with deflate by default, since they are extracted with zipfile, which can only read
+# zstandard from python 3.14. zstandard is much faster at a similar ratio, so it can be enabled with
+# WEBLINX_ZIP_ZSTD=1 (needs python 3.14), if every reader of the zips also runs python 3.14 or later.
+if os.environ.get('WEBLINX_ZIP_ZSTD') == '1':
+    if not hasattr(zipfile, 'ZIP_ZSTANDARD'):
+        raise RuntimeError("WEBLINX_ZIP_ZSTD=1 requires python 3.14 or later, which added zstandard to zipfile")
+    compression, compresslevel = zipfile.ZIP_ZSTANDARD, 3
 else:
-    with open(done_file, 'r') as f:
-        done = json.load(f)
+    compression, compresslevel = zipfile.ZIP_DEFLATED, 6
 
-# Iterate over all the items in the source directory
-pbar = tqdm(os.listdir(source_dir))
-for folder_name in pbar:
-    # update tqdm to show the folder name
-    pbar.set_description(f'Zipping: {folder_name}')
 
+def zip_one(folder_name):
     folder_path = os.path.join(source_dir, folder_name)
+    zip_filename = os.path.join(output_dir, f"{folder_name}.zip")
+
+    # Create the zip file
+    with zipfile.ZipFile(zip_filename, 'w', compression, compresslevel=compresslevel) as zipf:
+        # Walk through the directory and add all files to the zip
+        for root, dirs, files in os.walk(folder_path):
+            # the path relative to folder_path is the same for every file in root, so compute it once
+            rel_root = os.path.relpath(root, folder_path)
+            for file in files:
+                # Add file to the zip, but keep the folder structure
+                arcname = file if rel_root == '.' else os.path.join(rel_root, file)
+                zipf.write(os.path.join(root, file), arcname)
+
+    return folder_name, zip_filename
+
+
+def load_done():
+    if os.path.exists(done_file):
+        with open(done_file, 'r') as f:
+            return dict(json.loads(line) for line in f if line.strip())
+
+    if not os.path.exists(legacy_done_file):
+        return {}
+
+    with open(legacy_done_file, 'r') as f:
+        done = json.load(f)
+
+    with open(done_file, 'w') as f:
+        for folder_name, zip_filename in done.items():
+            f.write(json.dumps([folder_name, zip_filename]) + "\n")
+
+    return done
+
+
+if __name__ == "__main__":
+    # Create the output directory if it doesn't exist
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    done = load_done()
+
+    # Only zip directories, and skip the ones that were already zipped
+    todo = [
+        folder_name
+        for folder_name in os.listdir(source_dir)
+        if folder_name not in done and os.path.isdir(os.path.join(source_dir, folder_name))
+    ]
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor, open(done_file, 'a') as done_fp:
+        pbar = tqdm(executor.map(zip_one, todo, chunksize=1), total=len(todo), desc='Zipping')
+        for folder_name, zip_filename in pbar:
+            # now that it's done, we add the folder to the done list
+            done[folder_name] = zip_filename
+            done_fp.write(json.dumps([folder_name, zip_filename]) + "\n")
+            done_fp.flush()
 
-    # Only zip directories
-    if os.path.isdir(folder_path):
-        zip_filename = os.path.join(output_dir, f"{folder_name}.zip")
-
-        # if the zip file already exists, skip this folder
-        if folder_name in done:
-            continue
-        
-        # Create the zip file
-        with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # Walk through the directory and add all files to the zip
-            for root, dirs, files in os.walk(folder_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    # Add file to the zip, but keep the folder structure
-                    zipf.write(file_path, os.path.relpath(file_path, folder_path))
-        
-        # now that it's done, we add the folder to the done list
-        done[folder_name] = zip_filename
-        with open(done_file, 'w') as f:
-            json.dump(done, f)
-        
-
-
-print("Zipping complete!")
-print(f"Zipped files are stored in {output_dir}")
\ No newline at end of file
+    print("Zipping complete!")
+    print(f"Zipped files are stored in {output_dir}")
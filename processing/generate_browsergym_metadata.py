@@ -1,8 +1,8 @@
-import json
+import csv
 from pathlib import Path
 import os
 
-import pandas as pd
+import ijson
 
 os.environ['BROWSERGYM_WEBLINX_REGISTER_TRAIN'] = "False"  
 os.environ['BROWSERGYM_WEBLINX_REGISTER_VALID'] = "False"
@@ -20,48 +20,85 @@ split_to_browsergym_split = {
     "test_cat": "test_cat",
 }
 
+fieldnames = ["task_name", "demo_name", "step", "split", "browsergym_split"]
+
 metadata_path = './metadata.json'
 save_base_dir = './bg_wl_data'
 
-with open(metadata_path, 'r') as f:
-    metadata = json.load(f)
 
-dfs = []
+def load_step_keys(metadata_path):
+    """
+    Read the split -> demo_id -> [step] keys of metadata.json. We only need the keys, so we scan the
+    file with ijson instead of loading it, which avoids building the dicts of every step.
+    """
+    step_keys = {}
 
-for split, metadata_split in metadata.items():
-    if split not in split_to_browsergym_split:
-        print(f"Skipping split {split}")
-        continue
+    with open(metadata_path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f):
+            if event != 'map_key':
+                continue
 
-    output_csv = []
-    acceptable_tasks = set(weblinx_browsergym.list_tasks(split=split))
-    for demo_id, demo_dict in metadata_split.items():
-        for step_num, step_dict in demo_dict.items():
-            # task_name,miniwob_category,comment,webgum_subset,browsergym_split
-            task_name = f"weblinx.{demo_id}.{step_num}"
+            # the prefix is the dot-separated path of the map that the key belongs to
+            if prefix == '':
+                step_keys[value] = {}
+            elif '.' not in prefix:
+                step_keys[prefix][value] = []
+            elif prefix.count('.') == 1:
+                split, demo_id = prefix.split('.')
+                step_keys[split][demo_id].append(value)
 
-            if task_name not in acceptable_tasks:
-                continue
+    return step_keys
+
+
+metadata = load_step_keys(metadata_path)
+
+task_metadata_dir = Path(save_base_dir, 'browsergym/task_metadata')
+task_metadata_dir.mkdir(parents=True, exist_ok=True)
+
+# the rows of every split are also written to the combined csv as we go, so we don't need to
+# keep them around to combine them at the end
+all_save_dir = task_metadata_dir / 'weblinx_all.csv'
+with open(all_save_dir, 'w', newline='') as all_f:
+    all_writer = csv.DictWriter(all_f, fieldnames=fieldnames, lineterminator="\n")
+    all_writer.writeheader()
+
+    for split, metadata_split in metadata.items():
+        if split not in split_to_browsergym_split:
+            print(f"Skipping split {split}")
+            continue
+
+        output_csv = []
+        # task names are "weblinx.<demo_id>.<step>", we keep the (demo_id, step) pairs so we only
+        # need to format the task name for the steps we keep
+        acceptable_tasks = frozenset(
+            tuple(task_name.split(".", 2)[1:])
+            for task_name in weblinx_browsergym.list_tasks(split=split)
+        )
+        for demo_id, step_nums in metadata_split.items():
+            for step_num in step_nums:
+                if (demo_id, step_num) not in acceptable_tasks:
+                    continue
+
+                # task_name,miniwob_category,comment,webgum_subset,browsergym_split
+                task_name = f"weblinx.{demo_id}.{step_num}"
+
+                output_csv.append({
+                    "task_name": task_name,
+                    'demo_name': demo_id,
+                    'step': step_num,
+                    "split": split,
+                    "browsergym_split": split_to_browsergym_split[split],
+                })
 
-            output_csv.append({
-                "task_name": task_name,
-                'demo_name': demo_id,
-                'step': step_num,
-                "split": split,
-                "browsergym_split": split_to_browsergym_split[split],
-            })
+        print(f"{split}: Found {len(output_csv)} tasks")
 
-    print(f"{split}: Found {len(output_csv)} tasks")
-    df = pd.DataFrame(output_csv)
-    dfs.append(df)
+        save_dir = task_metadata_dir / f'weblinx_{split}.csv'
 
-    save_dir = Path(save_base_dir, f'browsergym/task_metadata/weblinx_{split}.csv')
-    save_dir.parent.mkdir(parents=True, exist_ok=True)
+        with open(save_dir, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(output_csv)
 
-    df.to_csv(save_dir, index=False)
+        all_writer.writerows(output_csv)
 
-# combine all splits
-df = pd.concat(dfs)
-save_dir = Path(save_base_dir, 'browsergym/task_metadata/weblinx_all.csv')
-df.to_csv(save_dir, index=False)
-print(f"Saved combined metadata to {save_dir}")
\ No newline at end of file
+print(f"Saved combined metadata to {all_save_dir}")
@@ -2,9 +2,11 @@ import logging
 from pathlib import Path
 from socket import timeout
 import os
-import json
+import re
+import struct
 from textwrap import dedent
 import signal
+from concurrent.futures import ProcessPoolExecutor
 
 import browsergym.core.observation
 from browsergym.core.observation import (
@@ -13,8 +15,9 @@ from browsergym.core.observation import (
     extract_dom_snapshot,
     extract_merged_axtree,
 )
-from PIL import Image
-from playwright.sync_api import sync_playwright, Browser
+import numpy as np
+import orjson
+from playwright.sync_api import sync_playwright, Page
 from tqdm.auto import tqdm
 import weblinx.utils
 
@@ -48,6 +51,12 @@ def wrap_with_timeout(function, timeout):
     return wrapper
 
 
+# "BIDaaaaaaaaxbbbbxcccc" where a, b, c are hex digits, see convert_temporary_id_format_to_bid
+temporary_id_pattern = re.compile(r"BID[0-9a-f]{8}x[0-9a-f]{4}x[0-9a-f]*")
+# translation table to replace the x's of the temporary format with -'s in a single pass
+temporary_id_translation = str.maketrans("x", "-")
+
+
 def convert_temporary_id_format_to_bid(temp_id: str) -> str:
     """
     The temporary format is in the form of "BIDaaaaaaaaxbbbbxcccc" where a, b, c are hex digits.
@@ -58,38 +67,25 @@ def convert_temporary_id_format_to_bid(temp_id: str) -> str:
     if not temp_id.startswith("BID"):
         raise ValueError(f"Invalid temporary id format: {temp_id}")
 
-    temp_id = temp_id[3:]
-    temp_id = temp_id.replace("x", "-")
-    return temp_id
+    return temp_id[3:].translate(temporary_id_translation)
 
 
-def is_temporary_id_format(temp_id: str) -> str:
+def is_temporary_id_format(temp_id: str) -> bool:
     """
     Check if the id is in the temporary format.
     """
-    if not temp_id.startswith("BID"):
-        return False
-
-    temp_id = temp_id[3:]
-    # count number of x's
-    if temp_id.count("x") != 2 or temp_id[8] != "x" or temp_id[13] != "x":
-        return False
-
-    # now, verify that the rest are hex digits
-    for c in temp_id:
-        if c not in "0123456789abcdefx":
-            return False
-
-    return True
+    return temporary_id_pattern.fullmatch(temp_id) is not None
 
 
 def remap_dom_snapshot_bid(dom_snapshot: dict) -> dict:
     """
     Here, we look at all the dom_snapshot['strings'] and replace the temporary ids with the weblinx format.
     """
-    for i, text in enumerate(dom_snapshot["strings"]):
+    strings = dom_snapshot["strings"]
+    for i, text in enumerate(strings):
+        # most strings are not ids, so we only write back the ones that match
         if is_temporary_id_format(text):
-            dom_snapshot["strings"][i] = convert_temporary_id_format_to_bid(text)
+            strings[i] = convert_temporary_id_format_to_bid(text)
 
 
 def remap_axtree_bid(axtree: dict) -> dict:
@@ -115,95 +111,38 @@ def remap_extra_props_bid(extra_props: dict) -> dict:
     return new_props
 
 
-def compute_visibility(bbox: dict, screen_width, screen_height) -> str:
-    # get proportions of the bounding box with respect to the screen
-    x = bbox["x"]
-    y = bbox["y"]
-    width = bbox["width"]
-    height = bbox["height"]
-
-    # check if the bounding box is outside the screen
-    if x + width < 0 or x > screen_width or y + height < 0 or y > screen_height:
-        return 0
+def compute_visibilities(bboxes: list, screen_width, screen_height) -> list:
+    """
+    Compute the proportion of each bounding box that is inside the screen, for a list of bounding boxes at once.
+    The visibility is 0 for bounding boxes outside the screen and 1 for the ones completely inside it.
+    """
+    arr = np.array(
+        [[b["x"], b["y"], b["width"], b["height"]] for b in bboxes], dtype=np.float64
+    ).reshape(-1, 4)
+    x, y, width, height = arr.T
 
-    # check if the bounding box is completely inside the screen
-    if x >= 0 and y >= 0 and x + width <= screen_width and y + height <= screen_height:
-        return 1
+    # check if the bounding box is outside the screen, or completely inside the screen
+    outside = (x + width < 0) | (x > screen_width) | (y + height < 0) | (y > screen_height)
+    inside = (x >= 0) & (y >= 0) & (x + width <= screen_width) & (y + height <= screen_height)
 
     # calculate the proportion of the bounding box that is inside the screen
-    x1 = max(x, 0)
-    y1 = max(y, 0)
-    x2 = min(x + width, screen_width)
-    y2 = min(y + height, screen_height)
+    x1 = np.maximum(x, 0)
+    y1 = np.maximum(y, 0)
+    x2 = np.minimum(x + width, screen_width)
+    y2 = np.minimum(y + height, screen_height)
 
     area = (x2 - x1) * (y2 - y1)
     total_area = width * height
-    if total_area <= 0:
-        return 0
-    
-    vis = area / total_area
-
-    return vis
-
-
-def compute_iou(bbox1: dict, bbox2: dict) -> float:
-    """
-    Compute the intersection over union of two bounding boxes.
-    """
-    x1 = bbox1["x"]
-    y1 = bbox1["y"]
-    w1 = bbox1["width"]
-    h1 = bbox1["height"]
-
-    x2 = bbox2["x"]
-    y2 = bbox2["y"]
-    w2 = bbox2["width"]
-    h2 = bbox2["height"]
-
-    # get the coordinates of the intersection rectangle
-    xA = max(x1, x2)
-    yA = max(y1, y2)
-    xB = min(x1 + w1, x2 + w2)
-    yB = min(y1 + h1, y2 + h2)
-
-    # compute the area of intersection rectangle
-    interArea = max(0, xB - xA) * max(0, yB - yA)
-
-    # compute the area of both the prediction and ground-truth rectangles
-    boxAArea = w1 * h1
-    boxBArea = w2 * h2
-
-    # compute the intersection over union by taking the intersection area and dividing it by the sum of prediction + ground-truth areas - the intersection area
-    iou = interArea / float(boxAArea + boxBArea - interArea)
-
-    return iou
-
-
-def infer_set_of_marks(
-    key: dict,
-    bboxes: dict,
-    existing_soms: dict,
-    iou_threshold=0.9,
-    area_px_threshold=25,
-) -> bool:
-    """
-    This function will deduplicate the set of marks by checking if the exact bounding box already exists in the
-    existing_soms. If it does, we return False, otherwise, we return True, and add the bounding box to the existing_soms.
-    """
-    bbox = bboxes[key]
-
-    for k, val in existing_soms.items():
-        # if iou is greater than the threshold, we return False
-        if compute_iou(bbox, val) > iou_threshold:
-            return False
-
-        # now, if the area of the bounding box is less than the threshold, we return False
-        if bbox["width"] * bbox["height"] < area_px_threshold:
-            return False
-
-    existing_soms[key] = bbox
-
-    return True
+    has_area = total_area > 0
+    partial = np.divide(area, total_area, out=np.zeros_like(area), where=has_area)
+
+    # fully outside, fully inside and empty boxes are saved as the ints 0 and 1, partial visibilities as floats
+    return [
+        0 if is_outside else 1 if is_inside else vis if is_nonempty else 0
+        for is_outside, is_inside, is_nonempty, vis in zip(
+            outside.tolist(), inside.tolist(), has_area.tolist(), partial.tolist()
+        )
+    ]
 
 
 def update_extra_props_with_bboxes(
@@ -212,28 +151,36 @@ def update_extra_props_with_bboxes(
     """
     Given the extra_props and bboxes, we update the bounding box in extra_props with the bounding box in bboxes.
     """
+    # compute the visibility of all the bounding boxes at once, in the order of extra_props
+    keys_with_bbox = [key for key in extra_props if key in bboxes]
+    visibilities = compute_visibilities(
+        [bboxes[key] for key in keys_with_bbox],
+        screen_width=screen_width,
+        screen_height=screen_height,
+    )
+    key_to_visibility = dict(zip(keys_with_bbox, visibilities))
+
     for key, value in extra_props.items():
-        existing_soms = {}
         if key in bboxes:
             b = bboxes[key]
             extra_props[key]["bbox"] = [b["x"], b["y"], b["width"], b["height"]]
-            extra_props[key]["visibility"] = compute_visibility(
-                b, screen_width=screen_width, screen_height=screen_height
-            )
-            extra_props[key]["set_of_marks"] = infer_set_of_marks(
-                key, bboxes, existing_soms=existing_soms
-            )
+            extra_props[key]["visibility"] = key_to_visibility[key]
+            # overlapping and small bounding boxes are filtered later on, in prepare_data_for_agentlab.py,
+            # so every element with a bounding box is a candidate for the set of marks here
+            extra_props[key]["set_of_marks"] = True
         else:
             extra_props[key]["visibility"] = 0
             extra_props[key]["set_of_marks"] = False
 
 
-def get_snapshot_from_path(html_file_path, browser: Browser):
+def get_snapshot_from_path(html_file_path, page: Page):
+    """
+    Get the snapshots of the html file by loading it in the given page. The page is reused across
+    html files, so it is reset to a blank page once the snapshots are taken.
+    """
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)
 
-    page = browser.new_page()
-
     # Convert the HTML file path to an absolute path
     absolute_path = os.path.abspath(html_file_path)
 
@@ -297,7 +244,6 @@ replace_and_inject();
     # we don't have the process CSS of the page. We will use the bounding boxes from bboxes.json
 
     # get the accessibility tree
-    # add a timeout to the function, if it takes too long, we will just skip it
     axtree_snapshot = extract_merged_axtree(page)
     extra_props = extract_dom_extra_properties(dom_snapshot=dom_snapshot)
 
@@ -308,20 +254,171 @@ replace_and_inject();
     # extra_props will give bad bounding boxes, need to post-process with bboxes.json
     extra_props = remap_extra_props_bid(extra_props)
 
-    # delete page
-    page.close()
+    # reset the page, so that nothing from this html file is left when loading the next one
+    page.goto("about:blank")
 
     return axtree_snapshot, dom_snapshot, extra_props
 
 
-def main(base_dir="./wl_data", allowed_demo_ids=None, skipped_demo_ids=None):
+def png_size(path: Path):
+    """
+    Get the (width, height) of a png image by reading its IHDR chunk, without decoding the image.
+    Returns None if the file is not a png.
+    """
+    with open(path, "rb") as f:
+        header = f.read(24)
+
+    # the 8 bytes signature is followed by the IHDR chunk, whose data starts with the width and height
+    if len(header) < 24 or header[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+
+    return struct.unpack(">II", header[16:24])
+
+
+def process_html_file(html_path: Path, base_dir: Path, page: Page, prefix: str) -> bool:
+    """
+    Get the snapshots of a single html file with the given page, and save them next to the html file.
+    Returns False if getting the snapshots failed, in which case the browser should be relaunched.
+    """
+    print()
+    # get the demo_id and name of the html file
+    demo_id = html_path.parts[-3]
+
+    name = html_path.stem
+    demo_dir = base_dir / "demonstrations" / demo_id
+
+    axtree_path = demo_dir / f"axtrees/{name}.json"
+    dom_snap_path = demo_dir / f"dom_snapshots/{name}.json"
+    extra_props_path = demo_dir / f"extra_element_properties/{name}.json"
+
+    index, index2 = weblinx.utils.get_nums_from_path(html_path)
+    bboxes_path = demo_dir / "bboxes" / f"bboxes-{index}.json"
+    screenshot_path = (
+        demo_dir / "screenshots" / f"screenshot-{index}-{index2}.png"
+    )
+
+    screen_size = png_size(screenshot_path) if screenshot_path.exists() else None
+
+    if screen_size is not None:
+        # get the widht and height of the screenshot from the png header without loading it
+        screen_width, screen_height = screen_size
+    else:
+        print(
+            f"{prefix} Screenshot does not exist or is not a png in '{screenshot_path}', defaulting to 1366 x 768"
+        )
+        screen_width, screen_height = 1366, 768
+
+    failed_path = axtree_path.parent / f"{name}-failed.json"
+
+    if failed_path.exists():
+        print(
+            f"{prefix} Snapshot processing previously failed, see {failed_path}"
+        )
+        return True
+
+    if not bboxes_path.exists():
+        print(f"{prefix} Bounding box file does not exist in '{bboxes_path}'")
+        return True
+
+    if (
+        axtree_path.exists()
+        and dom_snap_path.exists()
+        and extra_props_path.exists()
+    ):
+        print(f"{prefix} Accessibility tree already exists in '{axtree_path}'")
+        print(f"{prefix} DOM snapshot already exists in '{dom_snap_path}'")
+        print(
+            f"{prefix} Extra elem props already exists in '{extra_props_path}'"
+        )
+        return True
+
+    # each html file is only processed by one worker, but the directories are shared by the pages of a demo
+    axtree_path.parent.mkdir(parents=True, exist_ok=True)
+    dom_snap_path.parent.mkdir(parents=True, exist_ok=True)
+    extra_props_path.parent.mkdir(parents=True, exist_ok=True)
+
+    print(f"{prefix} Loading: {bboxes_path}")
+    with open(bboxes_path, "rb") as f:
+        bboxes = orjson.loads(f.read())
+
+    print(f"{prefix} Processing: {html_path}")
+
+    try:
+        # the workers are processes, so the alarm signal is delivered to the main thread of this worker
+        get_snapshot_from_path_timeout = wrap_with_timeout(
+            get_snapshot_from_path, timeout=20
+        )
+        axtree_snap, dom_snap, extra_props = get_snapshot_from_path_timeout(
+            html_file_path=html_path, page=page
+        )
+    except Exception as e:
+        print("=" * 50)
+        print(f"{prefix} Error in getting accessibility tree for {html_path}: ")
+        print(e)
+        print("-" * 50)
+        # save a "failed.json" file in the axtrees directory
+        with open(failed_path, "wb") as f:
+            f.write(orjson.dumps({"error": str(e), "html_file_path": str(html_path)}))
+        print(f"{prefix} Saved failed info json in: '{failed_path}'")
+        return False
+
+    update_extra_props_with_bboxes(
+        extra_props=extra_props,
+        bboxes=bboxes,
+        screen_width=screen_width,
+        screen_height=screen_height,
+    )
+    # in case of success, we print success message
+    print(f"{prefix} Completed without errors!")
+
+    # save the accessibility tree in axtree_file_path
+    with open(axtree_path, "wb") as f:
+        f.write(orjson.dumps(axtree_snap))
+    print(f"{prefix} Saved axtree tree in: '{axtree_path}'")
+
+    with open(dom_snap_path, "wb") as f:
+        f.write(orjson.dumps(dom_snap))
+    print(f"{prefix} Saved DOM snapshot in: '{dom_snap_path}'")
+
+    with open(extra_props_path, "wb") as f:
+        f.write(orjson.dumps(extra_props))
+    print(f"{prefix} Saved extra props in: '{extra_props_path}'")
+
+    return True
+
+
+def process_html_files(indexed_paths: list, base_dir: Path, total: int):
+    """
+    Worker that processes a chunk of html files with a single long-lived browser and page, rather
+    than launching a new browser for every file. indexed_paths is a list of (index, html_path) tuples,
+    where the index is only used for logging.
+    """
+    with sync_playwright() as p:
+        print(f"Launching browser for {len(indexed_paths)} pages")
+        browser = p.chromium.launch()
+        page = browser.new_context().new_page()
+
+        try:
+            for i, html_path in indexed_paths:
+                prefix = f"[{i+1}/{total}]"
+                succeeded = process_html_file(html_path, base_dir, page=page, prefix=prefix)
+
+                # after a failure (e.g. a timeout), the browser may be in a bad state, so we relaunch it
+                if not succeeded:
+                    browser.close()
+                    print(f"{prefix} Relaunching browser")
+                    browser = p.chromium.launch()
+                    page = browser.new_context().new_page()
+        finally:
+            browser.close()
+            print("Closed browser")
+
+
+def main(base_dir="./wl_data", allowed_demo_ids=None, skipped_demo_ids=None, num_workers=4):
 
     base_dir = Path(base_dir)
     # get all html files in base_dir/demonstrations/<demo_id>/pages/<name>.html and save them in
     # base_dir/demonstrations/<demo_id>/axtrees/<name>.json
-    relaunch_browser_rate = 1
-    total_so_far = 0
-
     file_lst = list(base_dir.glob("demonstrations/*/pages/*.html"))
 
     # filter based on allowed_demo_ids
@@ -334,132 +431,20 @@ def main(base_dir="./wl_data", allowed_demo_ids=None, skipped_demo_ids=None):
             and html_file_path.parts[-3] not in skipped_demo_ids
         ]
 
-    # with sync_playwright() as p:
-    # browser = p.chromium.launch()
-
-    for i, html_path in enumerate(file_lst):
-        print()
-        prefix = f"[{i+1}/{len(file_lst)}]"
-        # get the demo_id and name of the html file
-        demo_id = html_path.parts[-3]
-
-        name = html_path.stem
-        demo_dir = base_dir / "demonstrations" / demo_id
-
-        axtree_path = demo_dir / f"axtrees/{name}.json"
-        dom_snap_path = demo_dir / f"dom_snapshots/{name}.json"
-        extra_props_path = demo_dir / f"extra_element_properties/{name}.json"
-
-        index, index2 = weblinx.utils.get_nums_from_path(html_path)
-        bboxes_path = demo_dir / "bboxes" / f"bboxes-{index}.json"
-        screenshot_path = (
-            demo_dir / "screenshots" / f"screenshot-{index}-{index2}.png"
-        )
-
-        if screenshot_path.exists():
-            # get the widht and height of the screenshot from the metadata without loading
-            im = Image.open(screenshot_path)
-            screen_width, screen_height = im.size
-            im.close()
-        else:
-            print(
-                f"{prefix} Screenshot does not exist in '{screenshot_path}', defaulting to 1366 x 768"
-            )
-            screen_width, screen_height = 1366, 768
-
-        failed_path = axtree_path.parent / f"{name}-failed.json"
-
-        if failed_path.exists():
-            print(
-                f"{prefix} Snapshot processing previously failed, see {failed_path}"
-            )
-            continue
-
-        if not bboxes_path.exists():
-            print(f"{prefix} Bounding box file does not exist in '{bboxes_path}'")
-            continue
-
-        if (
-            axtree_path.exists()
-            and dom_snap_path.exists()
-            and extra_props_path.exists()
-        ):
-            print(f"{prefix} Accessibility tree already exists in '{axtree_path}'")
-            print(f"{prefix} DOM snapshot already exists in '{dom_snap_path}'")
-            print(
-                f"{prefix} Extra elem props already exists in '{extra_props_path}'"
-            )
-            continue
-
-        axtree_path.parent.mkdir(parents=True, exist_ok=True)
-        dom_snap_path.parent.mkdir(parents=True, exist_ok=True)
-        extra_props_path.parent.mkdir(parents=True, exist_ok=True)
-
-        # total_so_far += 1
-        # if total_so_far % relaunch_browser_rate == 0:
-        #     print(f"{prefix} Closing browser after {total_so_far} pages")
-        #     browser.close()
-        #     print(f"{prefix} Relaunching browser after {total_so_far} pages")
-        #     browser = p.chromium.launch()
-
-        print(f"{prefix} Loading: {bboxes_path}")
-        with open(bboxes_path, "r") as f:
-            bboxes = json.load(f)
-
-        with sync_playwright() as p:
-            # now, get the screen width and height from the dataset
-            print(f"{prefix} Launching browser")
-            browser = p.chromium.launch()
-
-            print(f"{prefix} Processing: {html_path}")
-
-            try:
-                get_snapshot_from_path_timeout = wrap_with_timeout(
-                    get_snapshot_from_path, timeout=20
-                )
-                axtree_snap, dom_snap, extra_props = get_snapshot_from_path_timeout(
-                    html_file_path=html_path, browser=browser
-                )
-            except Exception as e:
-                print("=" * 50)
-                print(f"{prefix} Error in getting accessibility tree for {html_path}: ")
-                print(e)
-                print("-" * 50)
-                # save a "failed.json" file in the axtrees directory
-                with open(failed_path, "w") as f:
-                    json.dump({"error": str(e), "html_file_path": str(html_path)}, f)
-                print(f"{prefix} Saved failed info json in: '{failed_path}'")
-                browser.close()
-                print(f"{prefix} Closed browser")
-                continue
-
-            else:
-                update_extra_props_with_bboxes(
-                    extra_props=extra_props,
-                    bboxes=bboxes,
-                    screen_width=screen_width,
-                    screen_height=screen_height,
-                )
-                # in case of success, we print success message
-                print(f"{prefix} Completed without errors!")
-
-            # save the accessibility tree in axtree_file_path
-            with open(axtree_path, "w") as f:
-                json.dump(axtree_snap, f)
-            print(f"{prefix} Saved axtree tree in: '{axtree_path}'")
-
-            with open(dom_snap_path, "w") as f:
-                json.dump(dom_snap, f)
-            print(f"{prefix} Saved DOM snapshot in: '{dom_snap_path}'")
-
-            with open(extra_props_path, "w") as f:
-                json.dump(extra_props, f)
-            print(f"{prefix} Saved extra props in: '{extra_props_path}'")
-
-            browser.close()
-            print(f"{prefix} Closed browser")
+    # each worker keeps its own browser and gets an interleaved chunk of the files, so that
+    # the workers get a similar mix of demos
+    indexed_paths = list(enumerate(file_lst))
+    chunks = [indexed_paths[k::num_workers] for k in range(num_workers)]
+    chunks = [chunk for chunk in chunks if len(chunk) > 0]
 
-    # browser.close()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(process_html_files, chunk, base_dir, total=len(file_lst))
+            for chunk in chunks
+        ]
+        for future in futures:
+            # re-raise any error that happened in a worker
+            future.result()
 
 
 # Example usage
@@ -482,7 +467,15 @@ if __name__ == "__main__":
         choices=["train", "valid", "test_iid", "test_vis", "test_geo", "test_cat", "test_web"],
     )
 
-    split = parser.parse_args().split
+    parser.add_argument(
+        "-n", "--num_workers",
+        type=int,
+        default=4,
+        help="The number of worker processes, each with its own browser.",
+    )
+
+    args = parser.parse_args()
+    split = args.split
 
     # splits are:
     #   train: The set used for training
@@ -503,4 +496,9 @@ if __name__ == "__main__":
         split_path=Path(base_dir, "splits.json"),
     )
 
-    main(base_dir, allowed_demo_ids=demo_ids, skipped_demo_ids=skipped_demo_ids)
+    main(
+        base_dir,
+        allowed_demo_ids=demo_ids,
+        skipped_demo_ids=skipped_demo_ids,
+        num_workers=args.num_workers,
+    )
@@ -7,131 +7,358 @@ of the data that needs to be uploaded to huggingface hub.
 
 import os
 from pathlib import Path
-import json
 import zipfile
 import shutil
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 
 
+import numpy as np
+import orjson
 from tqdm.auto import tqdm
 
-def verify_overlap_with_other_bboxes(bbox: dict, bboxes_list: list, iou_threshold=0.9):
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _any_iou_over_threshold(bboxes_arr, x1, y1, w1, h1, iou_threshold):
+    """
+    Check if the iou of the bounding box (x1, y1, w1, h1) with any of the bounding boxes in bboxes_arr
+    is over the threshold. This is written as a plain loop so that it can be compiled with numba.
+    """
+    boxAArea = w1 * h1
+    for i in range(bboxes_arr.shape[0]):
+        x2 = bboxes_arr[i, 0]
+        y2 = bboxes_arr[i, 1]
+        w2 = bboxes_arr[i, 2]
+        h2 = bboxes_arr[i, 3]
+
+        # boxes that are separated along one of the axes have an iou of 0
+        if x1 + w1 <= x2 or x2 + w2 <= x1 or y1 + h1 <= y2 or y2 + h2 <= y1:
+            continue
+
+        interArea = (min(x1 + w1, x2 + w2) - max(x1, x2)) * (min(y1 + h1, y2 + h2) - max(y1, y2))
+        iou = interArea / (boxAArea + w2 * h2 - interArea)
+
+        if iou > iou_threshold:
+            return True
+
+    return False
+
+
+# numba is optional, if it is not installed we use the vectorized numpy version instead
+if njit is not None:
+    _any_iou_over_threshold = njit(cache=True)(_any_iou_over_threshold)
+else:
+    _any_iou_over_threshold = None
+
+
+def verify_overlap_with_other_bboxes(bbox: list, bboxes_arr: np.ndarray, iou_threshold=0.9):
     """
     Verify if a bounding box overlaps with other bounding boxes.
 
     Args:
-        bbox: dict
-            Bounding box dictionary.
-        bboxes_list: list
-            List of bounding box dictionaries.
+        bbox: list
+            Bounding box as [x, y, width, height].
+        bboxes_arr: np.ndarray
+            Array of shape (M, 4) of other bounding boxes, each as [x, y, width, height].
         iou_threshold: float
             Intersection over union threshold for overlapping bounding boxes.
 
     Returns:
         bool: True if the bounding box overlaps with other bounding boxes, False otherwise.
     """
-    for other_bbox in bboxes_list:
-        x1, y1, w1, h1 = bbox
-        x2, y2, w2, h2 = other_bbox
+    x1, y1, w1, h1 = bbox
 
-        xA = max(x1, x2)
-        yA = max(y1, y2)
-        xB = min(x1 + w1, x2 + w2)
-        yB = min(y1 + h1, y2 + h2)
+    if _any_iou_over_threshold is not None:
+        return _any_iou_over_threshold(
+            bboxes_arr, float(x1), float(y1), float(w1), float(h1), float(iou_threshold)
+        )
 
-        interArea = max(0, xB - xA) * max(0, yB - yA)
+    x2, y2, w2, h2 = bboxes_arr.T
 
-        boxAArea = w1 * h1
-        boxBArea = w2 * h2
+    # boxes that are separated along one of the axes have an iou of 0, which is the case for most
+    # elements of a page, so we only compute the iou of the remaining ones
+    not_separated = (x2 < x1 + w1) & (x1 < x2 + w2) & (y2 < y1 + h1) & (y1 < y2 + h2)
+    if not not_separated.any():
+        return False
 
-        iou = interArea / float(boxAArea + boxBArea - interArea)
+    x2, y2, w2, h2 = x2[not_separated], y2[not_separated], w2[not_separated], h2[not_separated]
 
-        if iou > iou_threshold:
-            return True
+    # compute the iou against all the other bounding boxes at once
+    xA = np.maximum(x1, x2)
+    yA = np.maximum(y1, y2)
+    xB = np.minimum(x1 + w1, x2 + w2)
+    yB = np.minimum(y1 + h1, y2 + h2)
 
-    return False
+    interArea = np.clip(xB - xA, 0, None) * np.clip(yB - yA, 0, None)
 
-def sort_uid_by_area(extra_props: dict):
+    boxAArea = w1 * h1
+    boxBArea = w2 * h2
+
+    iou = interArea / (boxAArea + boxBArea - interArea)
+
+    return bool((iou > iou_threshold).any())
+
+def get_grid_cells(bbox: list, cell_size: int):
     """
-    Sort the unique IDs in extra properties by area of the bounding box.
+    Get the cells of a uniform grid that a bounding box spans.
 
     Args:
-        extra_props: dict
-            Extra properties dictionary.
+        bbox: list
+            Bounding box as [x, y, width, height].
+        cell_size: int
+            Size of the grid cells, in pixels.
 
     Returns:
-        list: List of unique IDs sorted by area of the bounding box.
+        list: List of (column, row) tuples of the cells spanned by the bounding box.
     """
-    uid_to_area = {}
+    x, y, w, h = bbox
+    return [
+        (col, row)
+        for col in range(int(x // cell_size), int((x + w) // cell_size) + 1)
+        for row in range(int(y // cell_size), int((y + h) // cell_size) + 1)
+    ]
+
+def find_overlapping_bboxes(bboxes_arr: np.ndarray, iou_threshold=0.9, cell_size=128):
+    """
+    Find the bounding boxes that overlap with one of the bounding boxes that come before them.
 
-    for uid, props in extra_props.items():
-        if props["bbox"] is None:
-            uid_to_area[uid] = 0
-        else:
-            x, y, w, h = props["bbox"]
-            uid_to_area[uid] = w * h
-    
-    # sort ascending
-    sorted_uids = list(sorted(uid_to_area, key=uid_to_area.get))
-    return sorted_uids
-    
-def remove_overlapping_bboxes(extra_props: dict, iou_threshold=0.9, inplace=True):
+    Args:
+        bboxes_arr: np.ndarray
+            Array of shape (N, 4) of bounding boxes, each as [x, y, width, height], in the order
+            in which they should be checked.
+        iou_threshold: float
+            Intersection over union threshold for overlapping bounding boxes.
+        cell_size: int
+            Size of the cells of the grid used to find the bounding boxes that may overlap, in pixels.
+
+    Returns:
+        np.ndarray: Boolean array of shape (N,), True for the bounding boxes that overlap with a previous one.
+    """
+    is_overlapping = np.zeros(len(bboxes_arr), dtype=bool)
+    # map each grid cell to the indices of the bounding boxes that span it, so that we only compute the iou
+    # against bounding boxes that share a cell with the candidate, since the others cannot intersect it
+    grid = {}
+
+    for i, bbox in enumerate(bboxes_arr.tolist()):
+        cells = get_grid_cells(bbox, cell_size)
+
+        neighbors = set()
+        for cell in cells:
+            neighbors.update(grid.get(cell, ()))
+
+        if neighbors:
+            neighbors_idx = np.fromiter(neighbors, dtype=np.intp, count=len(neighbors))
+            is_overlapping[i] = verify_overlap_with_other_bboxes(
+                bbox, bboxes_arr[neighbors_idx], iou_threshold
+            )
+
+        for cell in cells:
+            grid.setdefault(cell, []).append(i)
+
+    return is_overlapping
+
+def process_extra_props(extra_props, min_area=20, max_area=1_000_000, iou_threshold=0.9, cell_size=128):
     """
-    Remove overlapping bounding boxes in extra properties.
+    Preprocess the extra properties and remove the overlapping bounding boxes, in a single pass over
+    extra_props. Elements without a valid bounding box lose their set_of_marks and clickable
+    properties, and elements whose bounding box area is outside [min_area, max_area] lose their
+    set_of_marks. The remaining ones are sorted by bounding box area (ties keep the order of
+    extra_props), and each one loses its set_of_marks if its iou with any of the ones before it is
+    over iou_threshold.
 
     Args:
         extra_props: dict
             Extra properties dictionary.
+        min_area: int
+            Minimum area of a bounding box to keep its set_of_marks.
+        max_area: int
+            Maximum area of a bounding box to keep its set_of_marks.
         iou_threshold: float
             Intersection over union threshold for overlapping bounding boxes.
+        cell_size: int
+            Size of the cells of the grid used to find the bounding boxes that may overlap, in pixels.
 
     Returns:
-        dict: Extra properties dictionary with overlapping bounding boxes removed.
+        dict: Extra properties dictionary, updated inplace.
     """
-    if not inplace:
-        extra_props = deepcopy(extra_props)
+    num_props = len(extra_props)
+    uids = [None] * num_props
+    bboxes_arr = np.empty((num_props, 4), dtype=np.float64)
+    areas = np.empty(num_props, dtype=np.float64)
+    num_candidates = 0
 
-    uids_sorted = sort_uid_by_area(extra_props)
-
-    other_bboxes = []
+    for uid, props in extra_props.items():
+        bbox = props["bbox"]
+        if bbox is None or len(bbox) != 4:
+            props["set_of_marks"] = 0
+            props["clickable"] = 0
+            continue
 
-    for uid in uids_sorted:
-        props = extra_props[uid]
+        x, y, width, height = bbox
+        area = width * height
+        if props["set_of_marks"] == 1 and not min_area <= area <= max_area:
+            props["set_of_marks"] = 0
 
-        original_som = props['set_of_marks']
-        if original_som == 0:
-            continue
-    
-        if props["bbox"] is None:
+        if props["set_of_marks"] == 0:
             continue
 
-        is_overlapping = verify_overlap_with_other_bboxes(props["bbox"], other_bboxes, iou_threshold)
-        if is_overlapping:
-            props['set_of_marks'] = 0
-        
-        other_bboxes.append(props["bbox"])
-        
+        uids[num_candidates] = uid
+        bboxes_arr[num_candidates] = bbox
+        areas[num_candidates] = area
+        num_candidates += 1
+
+    # sort ascending by area; a stable sort keeps the ties in the same order as extra_props
+    order = np.argsort(areas[:num_candidates], kind="stable")
+    is_overlapping = find_overlapping_bboxes(bboxes_arr[order], iou_threshold, cell_size)
+
+    for i in order[is_overlapping]:
+        extra_props[uids[i]]["set_of_marks"] = 0
+
     return extra_props
 
-def preprocess_extra_props(extra_props, min_area=20, max_area=1_000_000):
+def is_zip_outdated(zip_filename: Path, demo_dir: Path):
+    """
+    Check if the zip file of a demo needs to be created again, i.e. if it doesn't exist or if any file
+    in the demo directory was modified after the zip file.
+
+    Args:
+        zip_filename: Path
+            Path to the zip file of the demo.
+        demo_dir: Path
+            Path to the directory of the demo that is zipped.
+
+    Returns:
+        bool: True if the zip file needs to be created again, False otherwise.
+    """
+    if not zip_filename.exists():
+        return True
+
+    zip_mtime = zip_filename.stat().st_mtime
+
+    for root, dirs, files in os.walk(demo_dir):
+        for file in files:
+            if os.stat(os.path.join(root, file)).st_mtime > zip_mtime:
+                return True
+
+    return False
+
+def copy_demo_files(demo_id: str):
     """
-    This function ensures that extra properties will have set_of_marks and clickable properties set
-    to 1 if they are not present in the extra properties.
+    Copy the replay.json, metadata.json and form.json of a demo to the output directory, unless they
+    already exist.
+
+    Args:
+        demo_id: str
+            ID of the demo.
     """
-    for key in extra_props:
-        if extra_props[key]["bbox"] is None or len(extra_props[key]["bbox"]) != 4:
-            extra_props[key]["set_of_marks"] = 0
-            extra_props[key]["clickable"] = 0
+    replay_path = demos_dir / demo_id / "replay.json"
+    demo_metadata_path = demos_dir / demo_id / "metadata.json"
+    form_path = demos_dir / demo_id / "form.json"
+
+    demo_out_dir = output_dir / "demonstrations" / demo_id
+    demo_out_dir.mkdir(parents=True, exist_ok=True)
+
+    replay_path_output = demo_out_dir / "replay.json"
+    meta_path_output = demo_out_dir / "metadata.json"
+    form_path_output = demo_out_dir / "form.json"
+
+    if not replay_path_output.exists():
+        shutil.copyfile(replay_path, replay_path_output)
+    if not meta_path_output.exists():
+        shutil.copyfile(demo_metadata_path, meta_path_output)
+    if not form_path_output.exists():
+        shutil.copyfile(form_path, form_path_output)
+
+def process_demo_steps(demo_id: str, demo_dict: dict):
+    """
+    Copy the files needed by each task step of a demo to the output directory, preprocess their extra
+    properties, and zip the demo directory if it changed.
+
+    Args:
+        demo_id: str
+            ID of the demo.
+        demo_dict: dict
+            Dictionary of the steps of the demo, from metadata.json.
+    """
+    # whether any file of the demo was written in this run, in which case the zip needs to be updated
+    demo_was_updated = False
+    # output directories that were already created for this demo, to avoid a mkdir per copied file
+    created_dirs = set()
+
+    for step_id, step_dict in demo_dict.items():
+        step_num = int(step_id)
+
+        if not step_dict["is_task"] or not step_dict["has_full_snapshot"]:
             continue
-        
-        if extra_props[key]["set_of_marks"] == 1:
-            v = extra_props[key]["set_of_marks"]
-            x, y, width, height = extra_props[key]["bbox"]
-            # if area is less than 20, we set set_of_marks to 0, otherwise 1
-            is_within_area = min_area <= width * height <= max_area
-            extra_props[key]["set_of_marks"] = v if is_within_area else 0
 
-    return extra_props
+        extra_props_was_copied = False
+
+        # for each of those files, copy them to the output directory unless they already exist
+        for key in step_path_keys:
+            rel_path = step_dict[key]
+            if rel_path is None:
+                continue
+
+            # the output directory mirrors the demonstrations directory, so both paths share rel_path
+            path = demos_dir / rel_path
+            path_out = demos_output_dir / rel_path
+
+            # stat directly rather than with exists(), which does the same stat and discards the result
+            try:
+                os.stat(path)
+            except FileNotFoundError:
+                tqdm.write(f"File {path} does not exist")
+                continue
+
+            if not override_existing:
+                try:
+                    os.stat(path_out)
+                    continue
+                except FileNotFoundError:
+                    pass
+
+            if path_out.parent not in created_dirs:
+                path_out.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(path_out.parent)
+            tqdm.write(f"Copying {path} to {path_out}")
+            shutil.copyfile(path, path_out)
+            extra_props_was_copied = True
+            demo_was_updated = True
+
+        # for extra_props_path, we need to preprocess the file to remove overlapping bounding boxes
+        if extra_props_was_copied and UPDATE_EXTRA_PROPS:
+            extra_props_path_out = demos_output_dir / step_dict["extra_props_path"]
+            tqdm.write(f"Processing {extra_props_path_out}")
+            with open(extra_props_path_out, "rb") as f:
+                extra_properties = orjson.loads(f.read())
+
+            extra_properties = process_extra_props(
+                extra_properties, min_area=50, max_area=500_000, iou_threshold=0.75
+            )
+
+            with open(extra_props_path_out, "wb") as f:
+                f.write(orjson.dumps(extra_properties))
+
+    # if the zip file doesn't exist or is older than the files of the demo, create it
+    zip_filename = demos_zip_dir / f"{demo_id}.zip"
+    demo_dir = demos_output_dir / demo_id
+
+    if demo_was_updated or is_zip_outdated(zip_filename, demo_dir):
+        tqdm.write("Zipping the output directory...")
+        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
+            # Walk through the directory and add all files to the zip
+            for root, dirs, files in os.walk(demo_dir):
+                for file in files:
+                    file_path = Path(root) / file
+                    # screenshots are already compressed, so deflating them again only costs time
+                    compress_type = zipfile.ZIP_STORED if file_path.suffix == ".png" else None
+                    # Add file to the zip, but keep the folder structure
+                    zipf.write(
+                        file_path, file_path.relative_to(demo_dir), compress_type=compress_type
+                    )
 
 UPDATE_EXTRA_PROPS = True
 override_existing = True
@@ -147,6 +374,16 @@ splits = [
 dataset_dir = "wl_data"
 output_dir = "bg_wl_data"
 metadata_path = "./metadata.json"
+# keys of the step dicts in metadata.json with the paths of the files to copy, relative to the demonstrations
+step_path_keys = (
+    "bbox_path",
+    "dom_object_path",
+    "axtree_path",
+    "extra_props_path",
+    "screenshot_path",
+    "html_path",
+)
+num_workers = os.cpu_count() * 2
 
 dataset_dir = Path(dataset_dir)
 output_dir = Path(output_dir)
@@ -163,114 +400,32 @@ shutil.copy(metadata_path, output_dir)
 print(f"Copied {metadata_path} to {output_dir}")
 
 # get the list of demo ids from metadata.json
-with open(metadata_path, "r") as f:
-    metadata = json.load(f)
+with open(metadata_path, "rb") as f:
+    metadata = orjson.loads(f.read())
 
 for split in splits:
-    demo_ids = list(metadata[split].keys())
+    demo_ids = [str(demo_id) for demo_id in metadata[split].keys()]
 
     # compute number of demo steps in the test path
     num_demo_steps = sum(len(demo_dict) for demo_dict in metadata[split].values())
     print(f"Number of demo steps: {num_demo_steps}")
 
-    # for each demo id, find it in demonstrations directory and copy replay.json, metadata.json,
-    # form.json, to the output directory
-    for demo_id in tqdm(demo_ids, desc="Copying replay.json, form.json, metadata.json"):
-        demo_id = str(demo_id)
-        replay_path = demos_dir / demo_id / "replay.json"
-        metadata_path = demos_dir / demo_id / "metadata.json"
-        form_path = demos_dir / demo_id / "form.json"
-
-        demo_out_dir = output_dir / "demonstrations" / demo_id
-        demo_out_dir.mkdir(parents=True, exist_ok=True)
-
-        replay_path_output = demo_out_dir / "replay.json"
-        meta_path_output = demo_out_dir / "metadata.json"
-        form_path_output = demo_out_dir / "form.json"
-
-        if not replay_path_output.exists():
-            shutil.copy(replay_path, replay_path_output)
-        if not meta_path_output.exists():
-            shutil.copy(metadata_path, meta_path_output)
-        if not form_path_output.exists():
-            shutil.copy(form_path, form_path_output)
-
-    for demo_id in tqdm(demo_ids, desc="Copying step files"):
-        demo_dict = metadata[split][demo_id]
-
-        for step_id, step_dict in demo_dict.items():
-            step_num = int(step_id)
-
-            if not step_dict["is_task"] or not step_dict["has_full_snapshot"]:
-                continue
-
-            bbox_path = demos_dir / step_dict["bbox_path"]
-            dom_object_path = demos_dir / step_dict["dom_object_path"]
-            axtree_path = demos_dir / step_dict["axtree_path"]
-            extra_props_path = demos_dir / step_dict["extra_props_path"]
-            screenshot_path = demos_dir / step_dict["screenshot_path"]
-            html_path = demos_dir / step_dict["html_path"]
-
-            extra_props_was_copied = False
-
-            # for each of those files, copy them to the output directory unless they already exist
-            for path in [
-                bbox_path,
-                dom_object_path,
-                axtree_path,
-                extra_props_path,
-                screenshot_path,
-                html_path,
-            ]:
-                if path is None:
-                    continue
-
-                path = Path(path)
-
-                if not path.exists():
-                    tqdm.write(f"File {path} does not exist")
-                    continue
-
-                path_out = output_dir / path.relative_to(dataset_dir)
-
-                if not path_out.exists() or override_existing:
-                    path_out.parent.mkdir(parents=True, exist_ok=True)
-                    tqdm.write(f"Copying {path} to {path_out}")
-                    shutil.copy(path, path_out)
-                    extra_props_was_copied = True
-
-            # for extra_props_path, we need to preprocess the file to remove overlapping bounding boxes
-            if extra_props_was_copied and UPDATE_EXTRA_PROPS:
-                tqdm.write(f"Processing {extra_props_path}")
-                extra_props_path_out = output_dir / extra_props_path.relative_to(
-                    dataset_dir
-                )
-                with open(extra_props_path_out, "r") as f:
-                    extra_properties = json.load(f)
-
-                extra_properties = preprocess_extra_props(
-                    extra_properties, min_area=50, max_area=500_000
-                )
-                remove_overlapping_bboxes(
-                    extra_properties, inplace=True, iou_threshold=0.75
-                )
-
-                with open(extra_props_path_out, "w") as f:
-                    json.dump(extra_properties, f)
-
-        # if the zip file doesn't exist, create it
-        tqdm.write("Zipping the output directory...")
-        zip_filename = demos_zip_dir / f"{demo_id}.zip"
-        demo_dir = demos_output_dir / demo_id
-
-        if not zip_filename.exists() or override_existing:
-            with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-                # Walk through the directory and add all files to the zip
-                for root, dirs, files in os.walk(demo_dir):
-                    for file in files:
-                        file_path = Path(root) / file
-                        # Add file to the zip, but keep the folder structure
-                        zipf.write(file_path, file_path.relative_to(demo_dir))
+    # the demos are independent and the work is mostly file I/O and zlib, which release the GIL,
+    # so we process the demos with a pool of threads
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # for each demo id, find it in demonstrations directory and copy replay.json, metadata.json,
+        # form.json, to the output directory
+        list(tqdm(
+            executor.map(copy_demo_files, demo_ids),
+            total=len(demo_ids),
+            desc="Copying replay.json, form.json, metadata.json",
+        ))
+
+        list(tqdm(
+            executor.map(process_demo_steps, demo_ids, [metadata[split][demo_id] for demo_id in demo_ids]),
+            total=len(demo_ids),
+            desc="Copying step files",
+        ))
 
 # print number of files in the output directory (recursively)
 num_files = sum(1 for _ in output_dir.rglob("*"))